@@ -1,13 +1,49 @@
+import argparse
+import gc
+import io
 import os
-from PIL import Image, ImageDraw
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+import PIL
+from PIL import Image, PdfParser, features
 import math
+import numpy as np
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Pillow warns about images over MAX_IMAGE_PIXELS and refuses ones over twice
+# that. 100 MP puts the hard limit at 200 MP (default ~179 MP), leaving room
+# for big phone and scanner photos without allowing much bigger bombs.
+Image.MAX_IMAGE_PIXELS = 100_000_000
+
+# One cut mark inside the CutBlock, indented to match ET.indent(space="  ")
+CUTMARK_TEMPLATE = (
+    '        <CutMark MarkType="CutContour" Center="{cx} {cy}" Size="{w} {h}" Unit="mm">\n'
+    '          <CutPath>\n'
+    '            <Rectangle LLx="{llx}" LLy="{lly}" URx="{urx}" URy="{ury}" Unit="mm" />\n'
+    '          </CutPath>\n'
+    '        </CutMark>\n'
+)
+
+# Placeholders spliced into the serialized JDF template
+_SHEET_ID_MARK = "@SHEET_ID@"
+_CUT_MARKS_MARK = "@CUT_MARKS@"
 
 def mm_to_pixels(mm, dpi=300):
     """Convert millimeters to pixels"""
     return int(mm * dpi / 25.4)
 
+def check_pillow_build():
+    """Point out when Pillow is missing the fast resize/decode paths"""
+    # Pillow-SIMD releases are tagged like "9.5.0.post1"
+    if 'post' not in PIL.__version__:
+        print("TIP: Stock Pillow detected - pillow-simd resizes 4-6x faster (see README)")
+    
+    if not features.check_feature('libjpeg_turbo'):
+        print("TIP: Pillow was built without libjpeg-turbo - JPEG cards decode slower")
+
 def setup_dimensions():
     """Set up paper and card dimensions"""
     # Using A3+ paper (329x483mm) - good for card printing
@@ -25,13 +61,14 @@ def setup_dimensions():
     
     # Convert everything to pixels (300 DPI)
     dpi = 300
-    paper_w = mm_to_pixels(paper_w_mm, dpi)
-    paper_h = mm_to_pixels(paper_h_mm, dpi)
-    card_w = mm_to_pixels(card_w_mm, dpi)
-    card_h = mm_to_pixels(card_h_mm, dpi)
-    card_bleed_w = mm_to_pixels(card_bleed_w_mm, dpi)
-    card_bleed_h = mm_to_pixels(card_bleed_h_mm, dpi)
-    bleed_px = mm_to_pixels(bleed_mm, dpi)
+    px_per_mm = dpi / 25.4
+    paper_w = int(paper_w_mm * px_per_mm)
+    paper_h = int(paper_h_mm * px_per_mm)
+    card_w = int(card_w_mm * px_per_mm)
+    card_h = int(card_h_mm * px_per_mm)
+    card_bleed_w = int(card_bleed_w_mm * px_per_mm)
+    card_bleed_h = int(card_bleed_h_mm * px_per_mm)
+    bleed_px = int(bleed_mm * px_per_mm)
     
     # Layout: 4 across, 5 down (fits nicely on A3+)
     cols = 4
@@ -70,16 +107,14 @@ def find_normal_cards():
         print(f"Can't find {backface}!")
         return []
     
-    cards = []
     normal_folder = "normal"
     
-    if os.path.exists(normal_folder):
-        for file in os.listdir(normal_folder):
-            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                front = os.path.join(normal_folder, file)
-                cards.append((front, backface))
+    if not os.path.exists(normal_folder):
+        return []
     
-    return cards
+    with os.scandir(normal_folder) as entries:
+        return [(entry.path, backface) for entry in entries
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
 
 def find_double_cards():
     """Find double-faced cards (different front/back)"""
@@ -89,63 +124,65 @@ def find_double_cards():
     if not os.path.exists(double_folder):
         return cards
     
-    for subfolder in os.listdir(double_folder):
-        subfolder_path = os.path.join(double_folder, subfolder)
-        if not os.path.isdir(subfolder_path):
-            continue
+    with os.scandir(double_folder) as subfolders:
+        for subfolder in subfolders:
+            if not subfolder.is_dir():
+                continue
             
-        images = []
-        for file in os.listdir(subfolder_path):
-            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                images.append(os.path.join(subfolder_path, file))
-        
-        # Pair up images (front/back)
-        for i in range(0, len(images) - 1, 2):
-            cards.append((images[i], images[i + 1]))
+            with os.scandir(subfolder.path) as entries:
+                images = [entry.path for entry in entries
+                          if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+            
+            # Pair up images (front/back)
+            for i in range(0, len(images) - 1, 2):
+                cards.append((images[i], images[i + 1]))
     
     return cards
 
-def prepare_card_image(image_path, card_w, card_h, bleed_px):
-    """Load and prepare a card image with bleed"""
+def prepare_card_image(image_path, card_w, card_h):
+    """Load a card image as a read-only (card_h, card_w, 3) array"""
     try:
         img = Image.open(image_path)
+
+        # Let libjpeg decode big JPEGs at a reduced scale (1/2, 1/4, 1/8).
+        # Asking for twice the final size keeps enough detail for LANCZOS.
+        if img.format == 'JPEG':
+            img.draft('RGB', (card_w * 2, card_h * 2))
+
         if img.mode != 'RGB':
             img = img.convert('RGB')
         
-        # Resize to fit card exactly
-        scale_w = card_w / img.width
-        scale_h = card_h / img.height
-        scale = max(scale_w, scale_h)  # Scale to fill completely
-        
-        new_w = int(img.width * scale)
-        new_h = int(img.height * scale)
-        img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        
-        # Crop to exact card size
-        left = (new_w - card_w) // 2
-        top = (new_h - card_h) // 2
-        card_img = img.crop((left, top, left + card_w, top + card_h))
-        
-        # Add black bleed border
-        final_w = card_w + (2 * bleed_px)
-        final_h = card_h + (2 * bleed_px)
-        final_img = Image.new('RGB', (final_w, final_h), 'black')
-        final_img.paste(card_img, (bleed_px, bleed_px))
-        
-        return final_img
+        # Scale to fill the card completely, cropping the overflow. The
+        # crop box is in source pixels so resize and crop happen in one pass,
+        # and reducing_gap lets oversized inputs (big PNGs, JPEGs that draft
+        # couldn't shrink enough) go through a cheap integer box reduce first.
+        scale = max(card_w / img.width, card_h / img.height)
+        src_w = card_w / scale
+        src_h = card_h / scale
+        left = (img.width - src_w) / 2
+        top = (img.height - src_h) / 2
+        card_img = img.resize((card_w, card_h), Image.Resampling.LANCZOS,
+                              box=(left, top, left + src_w, top + src_h), reducing_gap=3.0)
+        card_arr = np.asarray(card_img)
         
     except Exception as e:
         print(f"Problem with {image_path}: {e}")
         # Make a blank card if something goes wrong
-        final_w = card_w + (2 * bleed_px)
-        final_h = card_h + (2 * bleed_px)
-        blank = Image.new('RGB', (final_w, final_h), 'black')
-        white_card = Image.new('RGB', (card_w, card_h), 'white')
-        blank.paste(white_card, (bleed_px, bleed_px))
-        return blank
+        card_arr = np.full((card_h, card_w, 3), 255, np.uint8)
+    
+    # Backs are shared through the cache, so make sure nobody writes into it
+    card_arr.flags.writeable = False
+    return card_arr
 
-def make_cutting_file(output_dir, sheet_num, dims):
-    """Create JDF file for cutting machine"""
+# Small and bounded: it is there for the shared backface, while the backs of
+# double-faced cards are each only used once
+@lru_cache(maxsize=8)
+def prepare_back_image(image_path, card_w, card_h):
+    """Cached prepare_card_image for card backs"""
+    return prepare_card_image(image_path, card_w, card_h)
+
+def build_jdf_template(dims):
+    """Render the JDF text shared by every sheet's cutting file"""
     d = dims  # shorthand
     
     # Calculate card positions
@@ -160,7 +197,7 @@ def make_cutting_file(output_dir, sheet_num, dims):
     jdf = ET.Element("JDF", {
         "Type": "ProcessGroup",
         "Types": "Cutting", 
-        "ID": f"Sheet_{sheet_num + 1:02d}_Cutting",
+        "ID": _SHEET_ID_MARK,  # set per sheet by make_cutting_file
         "Status": "Waiting",
         "Version": "1.3"
     })
@@ -189,28 +226,22 @@ def make_cutting_file(output_dir, sheet_num, dims):
         "TrimSize": f"{d['paper_w_mm']} {d['paper_h_mm']}",
         "Unit": "mm"
     })
+    cut_block.text = _CUT_MARKS_MARK
     
-    # Add cut marks for each card
+    # Add cut marks for each card (layout values pulled out of the loop)
+    card_w, card_h = d['card_w_mm'], d['card_h_mm']
+    bleed_w, bleed_h = d['card_bleed_w_mm'], d['card_bleed_h_mm']
+    half_w, half_h = card_w / 2, card_h / 2
+    bleed = d['bleed_mm']
+    
+    cut_marks = []
     for row in range(d['rows']):
+        card_y = offset_y + (row * bleed_h) + bleed
         for col in range(d['cols']):
-            card_x = offset_x + (col * d['card_bleed_w_mm']) + d['bleed_mm']
-            card_y = offset_y + (row * d['card_bleed_h_mm']) + d['bleed_mm']
-            
-            cut_mark = ET.SubElement(cut_block, "CutMark", {
-                "MarkType": "CutContour",
-                "Center": f"{card_x + d['card_w_mm']/2} {card_y + d['card_h_mm']/2}",
-                "Size": f"{d['card_w_mm']} {d['card_h_mm']}",
-                "Unit": "mm"
-            })
-            
-            cut_path = ET.SubElement(cut_mark, "CutPath")
-            rect_path = ET.SubElement(cut_path, "Rectangle", {
-                "LLx": str(card_x),
-                "LLy": str(card_y), 
-                "URx": str(card_x + d['card_w_mm']),
-                "URy": str(card_y + d['card_h_mm']),
-                "Unit": "mm"
-            })
+            card_x = offset_x + (col * bleed_w) + bleed
+            cut_marks.append(CUTMARK_TEMPLATE.format(
+                cx=card_x + half_w, cy=card_y + half_h, w=card_w, h=card_h,
+                llx=card_x, lly=card_y, urx=card_x + card_w, ury=card_y + card_h))
     
     # Add metadata
     node_info = ET.SubElement(jdf, "NodeInfo", {
@@ -231,25 +262,29 @@ def make_cutting_file(output_dir, sheet_num, dims):
         "rRef": "CuttingParams_001"
     })
     
-    # Save the file
-    rough_string = ET.tostring(jdf, 'unicode')
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml = reparsed.toprettyxml(indent="  ")
-    pretty_xml = '\n'.join([line for line in pretty_xml.split('\n') if line.strip()])
+    ET.indent(jdf, space="  ")
+    jdf_text = ET.tostring(jdf, encoding='unicode', xml_declaration=True)
     
+    # Splice the cut marks in, closing </CutBlock> at its own indent level
+    return jdf_text.replace(_CUT_MARKS_MARK, "\n" + "".join(cut_marks) + "      ")
+
+def make_cutting_file(output_dir, sheet_num, jdf_template):
+    """Create JDF file for cutting machine"""
     jdf_file = os.path.join(output_dir, f"sheet_{sheet_num + 1:02d}_cutting.jdf")
     with open(jdf_file, 'w', encoding='utf-8') as f:
-        f.write(pretty_xml)
+        f.write(jdf_template.replace(_SHEET_ID_MARK, f"Sheet_{sheet_num + 1:02d}_Cutting"))
     
     return jdf_file
 
-def build_sheet(card_pairs, sheet_num, dims, is_back=False):
-    """Build one sheet of cards"""
+@lru_cache(maxsize=1)
+def _sheet_buffer(paper_h, paper_w):
+    """White page buffer reused for every sheet built in this process"""
+    return np.full((paper_h, paper_w, 3), 255, np.uint8)
+
+def build_sheet(sheet, card_pairs, sheet_num, dims, is_back=False, draw_grid=False):
+    """Build one sheet of cards in the sheet page buffer"""
     d = dims  # shorthand
     
-    # White background
-    sheet = Image.new('RGB', (d['paper_w'], d['paper_h']), 'white')
-    
     # Figure out which cards go on this sheet
     start_idx = sheet_num * d['cards_per_sheet']
     end_idx = min(start_idx + d['cards_per_sheet'], len(card_pairs))
@@ -260,34 +295,150 @@ def build_sheet(card_pairs, sheet_num, dims, is_back=False):
     offset_x = (d['paper_w'] - total_w) // 2
     offset_y = (d['paper_h'] - total_h) // 2
     
+    # Clear the card grid left over from the previous sheet back to white
+    sheet[offset_y:offset_y + total_h, offset_x:offset_x + total_w] = 255
+    
+    # The occupied slots form at most two blocks: the full rows, then the
+    # partial last row
+    full_rows, last_cols = divmod(end_idx - start_idx, d['cols'])
+    blocks = []  # (x, y, cols, rows)
+    if full_rows:
+        blocks.append((offset_x, offset_y, d['cols'], full_rows))
+    if last_cols:
+        blocks.append((offset_x, offset_y + (full_rows * d['card_bleed_h']), last_cols, 1))
+    
+    # Black bleed behind the cards, one fill per block
+    for x, y, cols, rows in blocks:
+        sheet[y:y + rows * d['card_bleed_h'], x:x + cols * d['card_bleed_w']] = 0
+    
     for i in range(start_idx, end_idx):
         card_pos = i - start_idx
         row = card_pos // d['cols']
         col = card_pos % d['cols']
         
-        # For back sheets, flip horizontally for double-sided printing
-        if is_back:
-            col = d['cols'] - 1 - col
-        
         # Position on sheet
         x = offset_x + (col * d['card_bleed_w'])
         y = offset_y + (row * d['card_bleed_h'])
         
         # Get the right image (front or back)
-        image_path = card_pairs[i][1 if is_back else 0]
-        card_img = prepare_card_image(image_path, d['card_w'], d['card_h'], d['bleed_px'])
-        
-        # Place card on sheet
-        sheet.paste(card_img, (x, y))
+        if is_back:
+            card_arr = prepare_back_image(card_pairs[i][1], d['card_w'], d['card_h'])
+        else:
+            card_arr = prepare_card_image(card_pairs[i][0], d['card_w'], d['card_h'])
         
-        # Add a blue border for reference
-        draw = ImageDraw.Draw(sheet)
-        draw.rectangle([x, y, x + d['card_bleed_w'] - 1, y + d['card_bleed_h'] - 1], 
-                      outline='blue', width=1)
-    
-    return sheet
+        # Place card on sheet, inside its bleed
+        x += d['bleed_px']
+        y += d['bleed_px']
+        sheet[y:y + d['card_h'], x:x + d['card_w']] = card_arr
+    
+    # Add a blue border around each card for reference. Every card edge is
+    # a line across the whole block, so each block is two slice writes.
+    if draw_grid:
+        for x, y, cols, rows in blocks:
+            right = x + cols * d['card_bleed_w']
+            bottom = y + rows * d['card_bleed_h']
+            line_xs = [x + (c * d['card_bleed_w']) + edge
+                       for c in range(cols) for edge in (0, d['card_bleed_w'] - 1)]
+            line_ys = [y + (r * d['card_bleed_h']) + edge
+                       for r in range(rows) for edge in (0, d['card_bleed_h'] - 1)]
+            sheet[y:bottom, line_xs] = (0, 0, 255)
+            sheet[line_ys, x:right] = (0, 0, 255)
+    
+    # Back sheets are laid out like the front, then the slot order of each
+    # row is reversed for double-sided printing (the card images themselves
+    # are not mirrored). With one shared back image the full rows read the
+    # same either way, so only the partial last row needs reversing.
+    if is_back:
+        used_rows = full_rows + (1 if last_cols else 0)
+        shared_back = len({pair[1] for pair in card_pairs[start_idx:end_idx]}) == 1
+        first_row = full_rows if shared_back else 0
+        if first_row < used_rows:
+            grid = sheet[offset_y + first_row * d['card_bleed_h']:
+                         offset_y + used_rows * d['card_bleed_h'],
+                         offset_x:offset_x + total_w]
+            slots = grid.reshape(used_rows - first_row, d['card_bleed_h'],
+                                 d['cols'], d['card_bleed_w'], 3)
+            slots[...] = slots[:, :, ::-1].copy()
+    
+    # fromarray must copy: the back is drawn into this same buffer next. It
+    # does for RGB, but would share the memory for modes like RGBA or L.
+    return Image.fromarray(sheet)
+
+def save_pdf(pdf_file, pages, dims):
+    """Save pages (front, back, front, back, ...) as one PDF"""
+    pages[0].save(pdf_file, format='PDF', save_all=True, append_images=pages[1:],
+                  resolution=dims['dpi'])
+    # Saving leaves the pages in a reference cycle; free them now instead of
+    # letting a page-sized chunk of memory pile up for every sheet
+    gc.collect()
+
+def encode_page(page):
+    """JPEG-encode a page the way Pillow's PDF writer would, returning (size, data)"""
+    data = io.BytesIO()
+    page.save(data, format='JPEG')
+    return page.size, data.getvalue()
+
+def start_combined_pdf(pdf_file, num_pages):
+    """Start a PDF with num_pages empty page slots for add_pdf_page to fill"""
+    pdf = PdfParser.PdfParser(pdf_file, mode='w+b')
+    pdf.start_writing()
+    pdf.write_header()
+    pdf.pages.extend(pdf.next_object_id(0) for _ in range(num_pages))
+    pdf.write_catalog()
+    return pdf
+
+def add_pdf_page(pdf, page_num, page, dims):
+    """Write an encode_page result into page slot page_num of the PDF"""
+    # Same objects Pillow's PDF writer makes, minus the JPEG encode
+    (width, height), data = page
+    image_ref = pdf.write_obj(None, stream=data,
+                              Type=PdfParser.PdfName('XObject'),
+                              Subtype=PdfParser.PdfName('Image'),
+                              Width=width, Height=height,
+                              Filter=PdfParser.PdfName('DCTDecode'),
+                              BitsPerComponent=8,
+                              ColorSpace=PdfParser.PdfName('DeviceRGB'))
+    
+    page_w = width * 72.0 / dims['dpi']
+    page_h = height * 72.0 / dims['dpi']
+    contents_ref = pdf.write_obj(None, stream=b"q %f 0 0 %f 0 0 cm /image Do Q\n" % (page_w, page_h))
+    pdf.write_page(page_num,
+                   Resources=PdfParser.PdfDict(
+                       ProcSet=[PdfParser.PdfName('PDF'), PdfParser.PdfName('ImageC')],
+                       XObject=PdfParser.PdfDict(image=image_ref)),
+                   MediaBox=[0, 0, page_w, page_h],
+                   Contents=contents_ref)
+
+def render_sheet(sheet_num, all_cards, dims, output_dir, jdf_template,
+                 per_sheet_pdf=False, draw_grid=False):
+    """Build one sheet and make its cutting file, returning (pages, saved_files)"""
+    # Front and back, both drawn in this worker's page buffer
+    sheet = _sheet_buffer(dims['paper_h'], dims['paper_w'])
+    front = build_sheet(sheet, all_cards, sheet_num, dims, is_back=False, draw_grid=draw_grid)
+    back = build_sheet(sheet, all_cards, sheet_num, dims, is_back=True, draw_grid=draw_grid)
+    
+    # Make cutting file
+    jdf_file = make_cutting_file(output_dir, sheet_num, jdf_template)
+    
+    # Encoding here keeps the slow part of writing the combined PDF in the
+    # workers; main only copies the JPEG data into the file
+    if not per_sheet_pdf:
+        return [encode_page(front), encode_page(back)], [jdf_file]
+    
+    pdf_file = os.path.join(output_dir, f"sheet_{sheet_num + 1:02d}.pdf")
+    save_pdf(pdf_file, [front, back], dims)
+    
+    return [], [pdf_file, jdf_file]
 
 def main():
+    parser = argparse.ArgumentParser(description="Impose card images onto print sheets")
+    parser.add_argument('--per-sheet', action='store_true',
+                        help="write one PDF per sheet instead of a single all_sheets.pdf")
+    parser.add_argument('--preview', action='store_true',
+                        help="draw blue reference lines around the cards")
+    args = parser.parse_args()
+    
+    check_pillow_build()
     dims = setup_dimensions()
     
     print("Looking for cards...")
@@ -313,32 +464,46 @@ def main():
     output_dir = "output_sheets"
     os.makedirs(output_dir, exist_ok=True)
     
-    # Create each sheet
-    for sheet_num in range(num_sheets):
-        print(f"Making sheet {sheet_num + 1}...")
-        
-        # Front and back
-        front = build_sheet(all_cards, sheet_num, dims, is_back=False)
-        back = build_sheet(all_cards, sheet_num, dims, is_back=True)
-        
-        # Save as PDF
-        pdf_file = os.path.join(output_dir, f"sheet_{sheet_num + 1:02d}.pdf")
-        
-        front = front.convert('RGB')
-        back = back.convert('RGB')
-        
-        front.save(pdf_file, format='PDF', save_all=True, 
-                  append_images=[back], resolution=dims['dpi'])
-        
-        # Make cutting file
-        jdf_file = make_cutting_file(output_dir, sheet_num, dims)
-        
+    # Create the sheets in parallel, one worker per CPU core. Only one sheet
+    # per worker is in flight, so finished pages don't pile up in memory
+    # while they are written to the combined PDF.
+    render = partial(render_sheet, all_cards=all_cards, dims=dims, output_dir=output_dir,
+                     jdf_template=build_jdf_template(dims), per_sheet_pdf=args.per_sheet,
+                     draw_grid=args.preview)
+    workers = os.cpu_count() or 1
+    pdf_file = os.path.join(output_dir, "all_sheets.pdf")
+    pdf = None if args.per_sheet else start_combined_pdf(pdf_file, 2 * num_sheets)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        next_sheet = 0
+        while next_sheet < num_sheets or in_flight:
+            while next_sheet < num_sheets and len(in_flight) < workers:
+                in_flight.append(executor.submit(render, next_sheet))
+                next_sheet += 1
+            
+            sheet_num = next_sheet - len(in_flight)
+            pages, saved_files = in_flight.popleft().result()
+            print(f"Made sheet {sheet_num + 1}")
+            
+            # All sheets go into one PDF, front then back
+            for page_num, page in enumerate(pages, start=2 * sheet_num):
+                add_pdf_page(pdf, page_num, page, dims)
+            
+            for saved_file in saved_files:
+                print(f"  Saved: {os.path.basename(saved_file)}")
+    
+    if pdf is not None:
+        pdf.write_xref_and_trailer()
+        pdf.close()
         print(f"  Saved: {os.path.basename(pdf_file)}")
-        print(f"  Saved: {os.path.basename(jdf_file)}")
     
     print(f"\nAll done! Check the '{output_dir}' folder.")
-    print("\nTo print: Print page 1, flip the paper, print page 2")
-    print("Blue lines show division between cards!")
+    if args.per_sheet:
+        print("\nTo print: Print page 1, flip the paper, print page 2")
+    else:
+        print("\nTo print: Print double-sided - each sheet's front is followed by its back")
+    if args.preview:
+        print("Blue lines show division between cards!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file